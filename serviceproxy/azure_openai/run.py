@@ -1,11 +1,12 @@
+import asyncio
 import os
 
 from dotenv import load_dotenv
-from openai import AzureOpenAI
+from openai import AsyncAzureOpenAI
 
 load_dotenv(override=True)
 
-client = AzureOpenAI(
+client = AsyncAzureOpenAI(
     api_key=os.getenv("AETHER_API_KEY"),
     azure_endpoint=os.getenv("AETHER_PROXY_ENDPOINT"),
     api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-01"),
@@ -13,12 +14,17 @@ client = AzureOpenAI(
 
 prompt = "Hi! Tell me about yourself."
 
-response = client.chat.completions.create(
-    model=os.getenv("AZURE_PROVIDER_MODEL"),
-    messages=[
-        {"role": "system", "content": "You are a helpful assistant."},
-        {"role": "user", "content": prompt},
-    ],
-)
 
-print(response.choices[0].message.content)
+async def main() -> None:
+    response = await client.chat.completions.create(
+        model=os.getenv("AZURE_PROVIDER_MODEL"),
+        messages=[
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": prompt},
+        ],
+    )
+
+    print(response.choices[0].message.content)
+
+
+asyncio.run(main())
@@ -0,0 +1,205 @@
+import functools
+import hashlib
+import json
+import threading
+from collections import OrderedDict, deque
+from typing import Any, Optional, Protocol
+
+from constants import (
+    CACHE_MAX_ENTRIES,
+    CACHE_TTL_SECONDS,
+    SEMANTIC_CACHE_MODEL,
+    SEMANTIC_CACHE_THRESHOLD,
+    SEMANTIC_CACHE_WINDOW,
+)
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # The semantic tier is optional.
+    SentenceTransformer = None
+
+
+def cache_key(
+    model: str, messages: list[dict[str, str]], temperature: Optional[float] = None
+) -> str:
+    """Build the exact-match cache key for a request.
+
+    Args
+    ----
+    model: str
+        The model the request is sent to, qualified with anything else that changes
+        the response (the provider, the mode).
+    messages: list of dict
+        The chat messages sent to the LLM.
+    temperature: float, optional
+        The sampling temperature; `None` when the provider's default is used.
+
+    Returns
+    -------
+    key: str
+        The SHA-256 hex digest of the request.
+    """
+
+    return _cache_key(
+        model,
+        tuple((message["role"], message["content"]) for message in messages),
+        temperature,
+    )
+
+
+# A request's key is looked up before the call and again when its response is stored;
+# memoize it rather than serializing and hashing the whole conversation twice.
+@functools.lru_cache(maxsize=CACHE_MAX_ENTRIES)
+def _cache_key(
+    model: str, messages: tuple[tuple[str, str], ...], temperature: Optional[float]
+) -> str:
+    payload = json.dumps(
+        {"model": model, "messages": messages, "temperature": temperature},
+        sort_keys=True,
+    )
+
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CacheBackend(Protocol):
+    """Storage for exact-match cache entries."""
+
+    def get(self, key: str) -> Optional[str]: ...
+
+    def set(self, key: str, value: str) -> None: ...
+
+
+class InMemoryCacheBackend:
+    """A thread-safe, size-bounded LRU cache held in process memory."""
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES):
+        self._max_entries = max_entries
+        self._entries: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+
+class RedisCacheBackend:
+    """A cache backend shared between processes through Redis."""
+
+    def __init__(self, url: str, ttl_seconds: int = CACHE_TTL_SECONDS):
+        import redis  # Only required when a Redis URL is configured.
+
+        self._client = redis.Redis.from_url(url)
+        self._ttl_seconds = ttl_seconds
+
+    def get(self, key: str) -> Optional[str]:
+        value = self._client.get(key)
+
+        return None if value is None else value.decode("utf-8")
+
+    def set(self, key: str, value: str) -> None:
+        self._client.set(key, value, ex=self._ttl_seconds)
+
+
+class LLMCache:
+    """A two-tier cache for LLM responses.
+
+    The first tier matches requests exactly on `cache_key`. The second, semantic tier
+    embeds the latest prompt locally and returns the response of a recent request, with
+    exactly the same earlier conversation, whose prompt's embedding is close enough to
+    it. Only the latest prompt is embedded, as the embedding model truncates long
+    inputs and a shared history would make every follow-up look alike. The semantic
+    tier is only enabled when `sentence-transformers` is installed, and its entries are
+    kept in process memory.
+
+    Args
+    ----
+    backend: CacheBackend, optional
+        The storage for exact-match entries. Defaults to an in-memory LRU cache.
+    semantic_threshold: float
+        The minimum cosine similarity for a semantic hit.
+    semantic_window: int
+        The number of recent requests the semantic tier compares against.
+    """
+
+    def __init__(
+        self,
+        backend: Optional[CacheBackend] = None,
+        semantic_threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        semantic_window: int = SEMANTIC_CACHE_WINDOW,
+    ):
+        self.backend = backend if backend is not None else InMemoryCacheBackend()
+        self.semantic_threshold = semantic_threshold
+        self._recent: deque[tuple[str, Any, str]] = deque(maxlen=semantic_window)
+        self._lock = threading.Lock()
+        self._embedder = None
+
+    @property
+    def is_semantic(self) -> bool:
+        return SentenceTransformer is not None
+
+    def _embed(self, messages: list[dict[str, str]]) -> Any:
+        with self._lock:
+            if self._embedder is None:
+                self._embedder = SentenceTransformer(SEMANTIC_CACHE_MODEL)
+
+        return self._embedder.encode(messages[-1]["content"], normalize_embeddings=True)
+
+    @staticmethod
+    def _semantic_scope(model: str, messages: list[dict[str, str]]) -> str:
+        # Semantic hits are only allowed between requests with the same model and the
+        # same earlier conversation.
+        return cache_key(model, messages[:-1])
+
+    def get(
+        self,
+        model: str,
+        messages: list[dict[str, str]],
+        temperature: Optional[float] = None,
+    ) -> Optional[str]:
+        """Look up a cached response, trying an exact match first."""
+
+        response = self.backend.get(cache_key(model, messages, temperature))
+        if response is not None or not self.is_semantic:
+            return response
+
+        scope = self._semantic_scope(model, messages)
+        embedding = self._embed(messages)
+        best_score, best_response = 0.0, None
+        with self._lock:
+            recent = list(self._recent)
+        for recent_scope, recent_embedding, recent_response in recent:
+            if recent_scope != scope:
+                continue
+            # The embeddings are normalized, so the dot product is the cosine.
+            score = float(embedding @ recent_embedding)
+            if score > best_score:
+                best_score, best_response = score, recent_response
+
+        return best_response if best_score >= self.semantic_threshold else None
+
+    def set(
+        self,
+        model: str,
+        messages: list[dict[str, str]],
+        response: str,
+        temperature: Optional[float] = None,
+    ) -> None:
+        """Store a response in both tiers."""
+
+        self.backend.set(cache_key(model, messages, temperature), response)
+        if self.is_semantic:
+            scope = self._semantic_scope(model, messages)
+            embedding = self._embed(messages)
+            with self._lock:
+                self._recent.append((scope, embedding, response))
@@ -0,0 +1,203 @@
+import asyncio
+import functools
+import threading
+from typing import Any, AsyncIterator, Coroutine, Iterator, Optional, TypeVar
+
+import google.generativeai as genai
+from google.generativeai import client as genai_client
+from openai import AsyncAzureOpenAI
+
+from coalescing import CoalescingClient
+from constants import SYSTEM_PROMPT
+
+T = TypeVar("T")
+
+# Streamlit re-executes `run.py` on every rerun, in a new thread, while the async SDK
+# clients keep connection pools that are bound to the event loop they were first used
+# on. Running every LLM call on one long-lived loop lets all sessions and reruns share
+# the same clients, and their open connections. This module is only imported once, so
+# the loop and the clients below outlive the reruns.
+_EVENT_LOOP = asyncio.new_event_loop()
+threading.Thread(
+    target=_EVENT_LOOP.run_forever, name="llm-event-loop", daemon=True
+).start()
+
+
+def run_async(coroutine: Coroutine[Any, Any, T]) -> T:
+    """Run a coroutine on the shared event loop and block until it completes.
+
+    Args
+    ----
+    coroutine: Coroutine
+        The coroutine to run.
+
+    Returns
+    -------
+    result
+        The value returned by the coroutine. Exceptions are re-raised in the caller's
+        thread.
+    """
+
+    return asyncio.run_coroutine_threadsafe(coroutine, _EVENT_LOOP).result()
+
+
+async def _next(iterator: AsyncIterator[T]) -> T:
+    return await iterator.__anext__()
+
+
+def iterate_async(iterator: AsyncIterator[T]) -> Iterator[T]:
+    """Iterate over an async iterator on the shared event loop, from synchronous code.
+
+    Args
+    ----
+    iterator: AsyncIterator
+        The async iterator (typically an async generator) to iterate over.
+
+    Yields
+    ------
+    item
+        The items of `iterator`, each fetched on the shared event loop.
+    """
+
+    try:
+        while True:
+            try:
+                yield run_async(_next(iterator))
+            except StopAsyncIteration:
+                return
+    finally:
+        # Let the generator clean up (close its HTTP stream) if iteration stopped
+        # early, e.g. because Streamlit interrupted the script for a rerun.
+        if hasattr(iterator, "aclose"):
+            run_async(iterator.aclose())
+
+
+@functools.lru_cache(maxsize=None)
+def get_azure_client(
+    api_key: str, azure_endpoint: str, api_version: str
+) -> AsyncAzureOpenAI:
+    """Return the Azure OpenAI client for an endpoint, creating it on first use.
+
+    The SDK's own retries are turned off; callers decide what to retry.
+
+    Args
+    ----
+    api_key: str
+        The API key to authenticate with.
+    azure_endpoint: str
+        The endpoint to send requests to.
+    api_version: str
+        The Azure OpenAI API version.
+
+    Returns
+    -------
+    client: AsyncAzureOpenAI
+        The client, shared by every call with the same arguments.
+    """
+
+    return AsyncAzureOpenAI(
+        api_key=api_key,
+        azure_endpoint=azure_endpoint,
+        api_version=api_version,
+        max_retries=0,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_coalescing_azure_client(
+    api_key: str, azure_endpoint: str, api_version: str
+) -> CoalescingClient:
+    """Return the Azure OpenAI client for an endpoint, coalescing identical requests.
+
+    Identical concurrent requests through it, from any session, share one call and
+    its response. Don't use it where every request has to reach the endpoint.
+
+    Args
+    ----
+    api_key: str
+        The API key to authenticate with.
+    azure_endpoint: str
+        The endpoint to send requests to.
+    api_version: str
+        The Azure OpenAI API version.
+
+    Returns
+    -------
+    client: CoalescingClient
+        The client, shared by every call with the same arguments.
+    """
+
+    return CoalescingClient(get_azure_client(api_key, azure_endpoint, api_version))
+
+
+# `genai.configure` replaces the Gemini SDK's global client configuration; it is only
+# called under this lock, and the client it produces is pinned on the models using it.
+_GEMINI_CONFIGURE_LOCK = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def get_gemini_client(api_key: str, api_endpoint: Optional[str] = None) -> Any:
+    """Return the Gemini client for a set of credentials, creating it on first use.
+
+    Args
+    ----
+    api_key: str
+        The API key to authenticate with.
+    api_endpoint: str, optional
+        The endpoint of a proxy to send requests to, over the REST transport. If not
+        given, requests are sent to the Gemini API directly.
+
+    Returns
+    -------
+    client: GenerativeServiceClient or GenerativeServiceAsyncClient
+        The blocking client for a proxy, as the SDK's async client does not support
+        the REST transport; the async client otherwise.
+    """
+
+    with _GEMINI_CONFIGURE_LOCK:
+        if api_endpoint is None:
+            genai.configure(api_key=api_key)
+
+            return genai_client.get_default_generative_async_client()
+
+        genai.configure(
+            api_key=api_key,
+            transport="rest",
+            client_options={"api_endpoint": api_endpoint},
+        )
+
+        return genai_client.get_default_generative_client()
+
+
+@functools.lru_cache(maxsize=8)
+def get_gemini_model(
+    model_name: str, api_key: str, api_endpoint: Optional[str] = None
+) -> genai.GenerativeModel:
+    """Return the Gemini model for a set of credentials, creating it on first use.
+
+    The model is bound to the client from `get_gemini_client`, rather than to whatever
+    client is globally configured when it is first called.
+
+    Args
+    ----
+    model_name: str
+        The name of the Gemini model.
+    api_key: str
+        The API key to authenticate with.
+    api_endpoint: str, optional
+        The endpoint of a proxy to send requests to. If not given, requests are sent to
+        the Gemini API directly.
+
+    Returns
+    -------
+    model: genai.GenerativeModel
+        The model, shared by every call with the same arguments.
+    """
+
+    model = genai.GenerativeModel(model_name, system_instruction=SYSTEM_PROMPT)
+    if api_endpoint is None:
+        model._async_client = get_gemini_client(api_key)
+    else:
+        model._client = get_gemini_client(api_key, api_endpoint)
+
+    return model
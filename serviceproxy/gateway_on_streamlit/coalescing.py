@@ -0,0 +1,126 @@
+import asyncio
+import json
+from typing import Any, AsyncIterator, Optional
+
+from openai import AsyncAzureOpenAI
+
+
+class _Flight:
+    """A request in flight, and what it has returned so far."""
+
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.followers = 0
+        self.started = False
+        self.finished = False
+        self.response: Any = None
+        self.chunks: list[Any] = []
+        self.error: Optional[BaseException] = None
+        self._updated = asyncio.Event()
+
+    def notify(self) -> None:
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    async def wait(self) -> None:
+        """Wait for the next change to the flight."""
+
+        await self._updated.wait()
+
+
+class CoalescingClient:
+    """Coalesce identical concurrent chat completion requests to Azure OpenAI.
+
+    A request that is identical to one already in flight is not sent again: it joins
+    the request in flight and shares its response. Streamed responses are buffered
+    as they arrive, so a request that joins late replays the chunks it missed before
+    following the stream. Requests are sent as soon as they arrive; nothing waits for
+    others to join.
+
+    Args
+    ----
+    client: openai.AsyncAzureOpenAI
+        The client to send requests with.
+    """
+
+    def __init__(self, client: AsyncAzureOpenAI):
+        self.client = client
+        self._inflight: dict[str, _Flight] = {}
+
+    async def create(self, **kwargs: Any) -> Any:
+        """Send a request; takes the arguments of `client.chat.completions.create`.
+
+        Returns
+        -------
+        response: ChatCompletion or AsyncIterator[ChatCompletionChunk]
+            The response, as `client.chat.completions.create` would return it.
+        """
+
+        key = json.dumps(kwargs, sort_keys=True, default=str)
+        flight = self._inflight.get(key)
+        if flight is None:
+            flight = self._inflight[key] = _Flight()
+            flight.task = asyncio.create_task(self._send(key, kwargs, flight))
+
+        flight.followers += 1
+        try:
+            while not (flight.started or flight.finished):
+                await flight.wait()
+            if not flight.started:
+                raise flight.error
+        except BaseException:
+            self._leave(key, flight)
+            raise
+
+        if not kwargs.get("stream"):
+            self._leave(key, flight)
+            return flight.response
+
+        return self._follow(key, flight)
+
+    def _leave(self, key: str, flight: _Flight) -> None:
+        flight.followers -= 1
+        if flight.followers == 0 and not flight.finished:
+            # Nobody is waiting for the response any more; stop reading it, and let the
+            # next identical request start afresh.
+            if self._inflight.get(key) is flight:
+                del self._inflight[key]
+            flight.task.cancel()
+
+    async def _follow(self, key: str, flight: _Flight) -> AsyncIterator[Any]:
+        index = 0
+        try:
+            while True:
+                while index < len(flight.chunks):
+                    yield flight.chunks[index]
+                    index += 1
+                if flight.finished:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                await flight.wait()
+        finally:
+            self._leave(key, flight)
+
+    async def _send(self, key: str, kwargs: dict[str, Any], flight: _Flight) -> None:
+        response = None
+        try:
+            response = await self.client.chat.completions.create(**kwargs)
+            flight.response, flight.started = response, True
+            flight.notify()
+            if kwargs.get("stream"):
+                async for chunk in response:
+                    flight.chunks.append(chunk)
+                    flight.notify()
+        except asyncio.CancelledError:
+            # Every caller has left; close the stream rather than reading it to the end.
+            if response is not None and kwargs.get("stream"):
+                await response.close()
+            raise
+        except Exception as e:
+            flight.error = e
+        finally:
+            if self._inflight.get(key) is flight:
+                del self._inflight[key]
+            flight.finished = True
+            flight.notify()
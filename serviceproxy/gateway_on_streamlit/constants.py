@@ -4,3 +4,58 @@ GOOGLE_GENERATIVEAI_MODELS = [
     "gemini-1.5-pro",
 ]
 LLM_PROVIDERS = ["google-generativeai", "azure-openai"]
+
+# Response cache settings.
+CACHE_MAX_ENTRIES = 1024
+CACHE_TTL_SECONDS = 60 * 60
+SEMANTIC_CACHE_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+SEMANTIC_CACHE_THRESHOLD = 0.92
+SEMANTIC_CACHE_WINDOW = 256
+
+# Request timeout settings.
+DEFAULT_REQUEST_TIMEOUT = 15.0
+REQUEST_MAX_ATTEMPTS = 3
+
+# Rate limiting settings. The limits are per model, in requests (`rpm`) and prompt
+# tokens (`tpm`) per minute; those of Azure OpenAI deployments depend on the
+# deployment, so they have to be configured.
+RATE_LIMITS = {
+    "gemini-1.5-flash": {"rpm": 2_000, "tpm": 4_000_000},
+    "gemini-1.5-flash-8b": {"rpm": 4_000, "tpm": 4_000_000},
+    "gemini-1.5-pro": {"rpm": 1_000, "tpm": 4_000_000},
+}
+RATE_LIMIT_BACKOFF = 1.0
+RATE_LIMIT_MAX_ATTEMPTS = 3
+
+# Token counting settings. The context window of each model, in tokens; Azure OpenAI
+# deployments are assumed to have `DEFAULT_CONTEXT_WINDOW`.
+CONTEXT_WINDOWS = {
+    "gemini-1.5-flash": 1_048_576,
+    "gemini-1.5-flash-8b": 1_048_576,
+    "gemini-1.5-pro": 2_097_152,
+}
+DEFAULT_CONTEXT_WINDOW = 128_000
+DEFAULT_TIKTOKEN_ENCODING = "o200k_base"
+TOKEN_COUNT_CACHE_ENTRIES = 10_000
+TOKENIZER_RETRY_SECONDS = 60.0
+
+# Admission control settings.
+DEFAULT_MAX_INFLIGHT = 16
+MAX_QUEUED = 128
+QUEUE_DEADLINE = 30.0
+
+# The system prompt that starts every conversation.
+SYSTEM_PROMPT = "You are a helpful assistant."
+
+# Model routing settings. The cheap model tried first for each provider; Azure OpenAI
+# deployments are named by the user, so theirs is set with `AZURE_ROUTER_MODEL`.
+CHEAP_MODELS = {"google-generativeai": "gemini-1.5-flash-8b"}
+ROUTER_LOGPROB_THRESHOLD = -1.0
+ROUTER_MAX_CHEAP_PROMPT_TOKENS = 800
+ROUTER_MAX_REMEMBERED_PROMPTS = 1024
+
+# Error handling settings.
+ERROR_MESSAGE_CACHE_ENTRIES = 256
+
+# User interface settings.
+HISTORY_CACHE_ENTRIES = 1024
@@ -1,9 +1,38 @@
 from constants import LLM_PROVIDERS
 
 
+class IncompleteResponseException(Exception):
+    message = "The LLM's response was interrupted; please try again."
+
+
+class InvalidEnvironmentVariableException(Exception):
+    message = "An environment variable has an invalid value; see the README."
+
+
+class LLMCallFailedException(Exception):
+    message = "The call to the LLM failed; please try again."
+
+    def __init__(self, message: str = "") -> None:
+        super().__init__(message)
+        if message:
+            self.message = message
+
+
 class LLMProviderNotFoundException(Exception):
     message = f"The LLM provider must be one of the following: {LLM_PROVIDERS}"
 
 
 class NoResponseException(Exception):
     message = "The LLM did not return a response."
+
+
+class PromptTooLongException(Exception):
+    message = "The conversation is too long for the model; please start a new one."
+
+
+class ServerBusyException(Exception):
+    message = "The server is busy; please try again in a moment."
+
+
+class MissingEnvironmentVariableException(Exception):
+    message = "A required environment variable is not set; see the README."
@@ -0,0 +1,218 @@
+import asyncio
+import contextlib
+import time
+from collections import defaultdict
+from typing import AsyncIterator, Optional
+
+from constants import RATE_LIMIT_BACKOFF
+from exceptions import ServerBusyException
+
+
+class TokenBucket:
+    """A token bucket holding up to a minute's worth of a per-minute limit.
+
+    Args
+    ----
+    per_minute: int
+        The number of tokens added to the bucket per minute; also its capacity.
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.tokens = float(per_minute)
+        self._rate = per_minute / 60
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self._updated) * self._rate
+        )
+        self._updated = now
+
+    def wait_time(self, amount: int) -> float:
+        """Return the time, in seconds, until `amount` tokens are available."""
+
+        self._refill()
+        # A request larger than the bucket would never fit; let it through when the
+        # bucket is full.
+        amount = min(amount, self.capacity)
+
+        return max(0.0, (amount - self.tokens) / self._rate)
+
+    def consume(self, amount: int) -> None:
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+
+class ProviderRateLimiter:
+    """Client-side rate limiting for LLM providers, keyed by provider and model.
+
+    Each model with configured limits gets a token bucket for requests per minute and
+    one for (prompt) tokens per minute. Requests wait in process, in order of arrival,
+    until both buckets admit them. When the provider rejects a request anyway (HTTP
+    429), `defer` holds back every request for that model until the provider's
+    `Retry-After` has passed.
+
+    Args
+    ----
+    limits: dict
+        The limits for each model name, as `{"rpm": ..., "tpm": ...}`. Models that
+        are not listed are not limited.
+    respect_retry_after: bool
+        If true, wait for the time given by the provider on 429s. Otherwise, back off
+        by a fixed `RATE_LIMIT_BACKOFF` seconds.
+
+    Attributes
+    ----------
+    queue_depth: int
+        The number of requests currently waiting to be admitted.
+    wait_time: float
+        The total time, in seconds, requests have spent waiting to be admitted.
+    """
+
+    def __init__(
+        self, limits: dict[str, dict[str, int]], respect_retry_after: bool = True
+    ):
+        self.limits = limits
+        self.respect_retry_after = respect_retry_after
+        self.queue_depth = 0
+        self.wait_time = 0.0
+        self._buckets: dict[tuple[str, str], tuple[TokenBucket, TokenBucket]] = {}
+        self._blocked_until: dict[tuple[str, str], float] = defaultdict(float)
+        self._locks: dict[tuple[str, str], asyncio.Lock] = defaultdict(asyncio.Lock)
+
+    async def acquire(self, llm_provider: str, model_name: str, tokens: int) -> None:
+        """Wait until a request of `tokens` prompt tokens may be sent.
+
+        Args
+        ----
+        llm_provider: str
+            The provider of the LLM.
+        model_name: str
+            The name of the model.
+        tokens: int
+            The estimated number of prompt tokens in the request.
+        """
+
+        limits = self.limits.get(model_name)
+        if limits is None:
+            return
+
+        key = (llm_provider, model_name)
+        if key not in self._buckets:
+            self._buckets[key] = (
+                TokenBucket(limits["rpm"]),
+                TokenBucket(limits["tpm"]),
+            )
+        rpm, tpm = self._buckets[key]
+
+        self.queue_depth += 1
+        start = time.monotonic()
+        try:
+            # Admit requests for the same model one at a time, in order of arrival.
+            async with self._locks[key]:
+                while True:
+                    delay = max(
+                        self._blocked_until[key] - time.monotonic(),
+                        rpm.wait_time(1),
+                        tpm.wait_time(tokens),
+                    )
+                    if delay <= 0:
+                        break
+                    await asyncio.sleep(delay)
+
+                rpm.consume(1)
+                tpm.consume(tokens)
+        finally:
+            self.queue_depth -= 1
+            self.wait_time += time.monotonic() - start
+
+    def defer(
+        self, llm_provider: str, model_name: str, retry_after: Optional[float]
+    ) -> float:
+        """Hold back requests for a model after the provider rate-limited one.
+
+        Args
+        ----
+        llm_provider: str
+            The provider of the LLM.
+        model_name: str
+            The name of the model.
+        retry_after: float, optional
+            The time, in seconds, the provider asked to wait for, if it did.
+
+        Returns
+        -------
+        delay: float
+            The time, in seconds, for which requests are held back.
+        """
+
+        delay = RATE_LIMIT_BACKOFF
+        if self.respect_retry_after and retry_after is not None:
+            delay = retry_after
+
+        key = (llm_provider, model_name)
+        self._blocked_until[key] = max(
+            self._blocked_until[key], time.monotonic() + delay
+        )
+
+        return delay
+
+
+class ConcurrencyLimiter:
+    """Bound the number of requests in flight, and of requests waiting for a slot.
+
+    Requests beyond `max_inflight` wait for a slot, but only up to `max_queued` of them
+    and for at most `queue_deadline` seconds each; others are turned away right away
+    with a `ServerBusyException`. This keeps memory and queueing latency bounded under
+    bursts, rather than letting old requests pile up.
+
+    Args
+    ----
+    max_inflight: int
+        The maximum number of requests in flight.
+    max_queued: int
+        The maximum number of requests waiting for a slot.
+    queue_deadline: float
+        The maximum time, in seconds, a request waits for a slot.
+    """
+
+    def __init__(self, max_inflight: int, max_queued: int, queue_deadline: float):
+        self.max_inflight = max_inflight
+        self.max_queued = max_queued
+        self.queue_deadline = queue_deadline
+        self.queued = 0
+        # The semaphore is bound to the event loop, so it is created on the first
+        # request rather than here.
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    @contextlib.asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Hold a slot for the duration of the `async with` block.
+
+        Raises
+        ------
+        ServerBusyException
+            If the queue is full, or no slot frees up before the deadline.
+        """
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_inflight)
+        if self._semaphore.locked() and self.queued >= self.max_queued:
+            raise ServerBusyException()
+
+        self.queued += 1
+        try:
+            await asyncio.wait_for(
+                self._semaphore.acquire(), timeout=self.queue_deadline
+            )
+        except asyncio.TimeoutError:
+            raise ServerBusyException() from None
+        finally:
+            self.queued -= 1
+
+        try:
+            yield
+        finally:
+            self._semaphore.release()
@@ -0,0 +1,163 @@
+import hashlib
+import re
+import string
+from collections import OrderedDict
+from typing import Optional, Sequence
+
+from constants import (
+    ROUTER_LOGPROB_THRESHOLD,
+    ROUTER_MAX_CHEAP_PROMPT_TOKENS,
+    ROUTER_MAX_REMEMBERED_PROMPTS,
+)
+
+CODE_RE = re.compile(r"```|^\s*(def|class|import|#include|SELECT)\b", re.MULTILINE)
+MATH_RE = re.compile(
+    r"\\(frac|sum|int|sqrt)\b|\$[^$\n]+\$|\d\s*[\^*/]\s*\d"
+    r"|\b(integral|derivative|prove|theorem|equation|matrix)\b",
+    re.IGNORECASE,
+)
+REFUSAL_RE = re.compile(
+    r"\b(I(?:'m| am) (?:sorry|unable|not able)|I can(?:no|')t (?:help|answer|assist)"
+    r"|as an AI)\b",
+    re.IGNORECASE,
+)
+
+GREETING_RE = re.compile(r"^(hi|hello|hey|yo)[\s!.?]*$", re.IGNORECASE)
+THANKS_RE = re.compile(
+    r"^(thanks|thank you|thx|ty)( (so|very) much)?[\s!.]*$", re.IGNORECASE
+)
+FAREWELL_RE = re.compile(r"^(bye|goodbye|see you)[\s!.]*$", re.IGNORECASE)
+# Prompts made only of ASCII punctuation, e.g. "???" or "..."; emoji and other
+# non-ASCII symbols are left for the LLM.
+NO_TEXT_RE = re.compile(rf"^[\s{re.escape(string.punctuation)}]+$")
+
+# The prompts answered locally, without calling the LLM, and their answers.
+DIRECT_RESPONSES = [
+    (GREETING_RE, "Hello! How may I assist you today?"),
+    (THANKS_RE, "You're welcome! Is there anything else I can help with?"),
+    (FAREWELL_RE, "Goodbye! Feel free to come back with more questions."),
+    (
+        NO_TEXT_RE,
+        "I couldn't find a question in your prompt; please re-type your prompt and "
+        "try again!",
+    ),
+]
+
+
+def direct_response(prompt: str) -> Optional[str]:
+    """Answer a trivial prompt locally.
+
+    Args
+    ----
+    prompt: str
+        The user's prompt.
+
+    Returns
+    -------
+    response: str, optional
+        The canned answer from `DIRECT_RESPONSES`, if the prompt matches one of its
+        rules; `None` if the prompt needs the LLM.
+    """
+
+    prompt = prompt.strip()
+    for pattern, response in DIRECT_RESPONSES:
+        if pattern.match(prompt):
+            return response
+
+    return None
+
+
+def _fingerprint(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+class ModelRouter:
+    """Send prompts to a cheap model first, escalating to the requested model.
+
+    Prompts that look complex (long, or containing code or maths) go straight to the
+    requested model. The others are tried on the cheap model, and are escalated if its
+    answer is a refusal or its average token log-probability is low. Prompts that had
+    to be escalated are remembered, so the cheap model isn't paid for them again.
+
+    Args
+    ----
+    logprob_threshold: float
+        The average token log-probability below which the cheap model's answer is
+        considered unreliable.
+    max_cheap_prompt_tokens: int
+        The length, in tokens, above which a prompt is considered complex.
+    """
+
+    def __init__(
+        self,
+        logprob_threshold: float = ROUTER_LOGPROB_THRESHOLD,
+        max_cheap_prompt_tokens: int = ROUTER_MAX_CHEAP_PROMPT_TOKENS,
+    ):
+        self.logprob_threshold = logprob_threshold
+        self.max_cheap_prompt_tokens = max_cheap_prompt_tokens
+        self._escalations: OrderedDict[str, int] = OrderedDict()
+
+    def is_complex(self, prompt: str, tokens: int) -> bool:
+        """Whether a prompt, of `tokens` tokens, should skip the cheap model."""
+
+        return (
+            tokens > self.max_cheap_prompt_tokens
+            or CODE_RE.search(prompt) is not None
+            or MATH_RE.search(prompt) is not None
+            or _fingerprint(prompt) in self._escalations
+        )
+
+    def route_model(
+        self, prompt: str, tokens: int, model_name: str, cheap_model: str
+    ) -> str:
+        """Pick the model to try first for a prompt.
+
+        Args
+        ----
+        prompt: str
+            The user's prompt.
+        tokens: int
+            The number of tokens in the prompt.
+        model_name: str
+            The model the user asked for.
+        cheap_model: str
+            The cheap model to try first.
+
+        Returns
+        -------
+        model_name: str
+            `cheap_model`, unless the prompt looks complex.
+        """
+
+        return model_name if self.is_complex(prompt, tokens) else cheap_model
+
+    def should_escalate(self, response: str, logprobs: Sequence[float] = ()) -> bool:
+        """Whether the cheap model's response should be replaced.
+
+        Args
+        ----
+        response: str
+            The cheap model's response.
+        logprobs: sequence of float
+            The log-probabilities of the response's tokens, if the provider returns
+            them.
+
+        Returns
+        -------
+        escalate: bool
+            True if the response is empty, a refusal, or not confident enough.
+        """
+
+        if not response.strip() or REFUSAL_RE.search(response):
+            return True
+
+        return bool(logprobs) and sum(logprobs) / len(logprobs) < self.logprob_threshold
+
+    def record_escalation(self, prompt: str) -> None:
+        """Remember that a prompt needed the requested model."""
+
+        key = _fingerprint(prompt)
+        self._escalations[key] = self._escalations.get(key, 0) + 1
+        self._escalations.move_to_end(key)
+        while len(self._escalations) > ROUTER_MAX_REMEMBERED_PROMPTS:
+            self._escalations.popitem(last=False)
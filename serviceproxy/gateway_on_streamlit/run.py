@@ -1,182 +1,788 @@
+import asyncio
+import contextlib
 import logging
-import os
-from typing import Literal, Union
+from typing import AsyncIterator, Awaitable, Callable, Literal, Optional, Sequence
 
-import google.generativeai as genai
+import httpx
 import streamlit as st
-from dotenv import load_dotenv
-from google.api_core.exceptions import GoogleAPIError
+from google.api_core.exceptions import (
+    DeadlineExceeded,
+    GoogleAPIError,
+    ResourceExhausted,
+)
 from openai import APIError as OpenAIAPIError
-from openai import AzureOpenAI
+from openai import APITimeoutError
+from openai import RateLimitError as OpenAIRateLimitError
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential,
+)
+
+from cache import LLMCache, RedisCacheBackend
+from clients import (
+    get_azure_client,
+    get_coalescing_azure_client,
+    get_gemini_model,
+    iterate_async,
+)
+from constants import (
+    CHEAP_MODELS,
+    CONTEXT_WINDOWS,
+    DEFAULT_CONTEXT_WINDOW,
+    DEFAULT_REQUEST_TIMEOUT,
+    GOOGLE_GENERATIVEAI_MODELS,
+    HISTORY_CACHE_ENTRIES,
+    LLM_PROVIDERS,
+    MAX_QUEUED,
+    QUEUE_DEADLINE,
+    RATE_LIMIT_MAX_ATTEMPTS,
+    RATE_LIMITS,
+    REQUEST_MAX_ATTEMPTS,
+    SYSTEM_PROMPT,
+)
+from exceptions import (
+    IncompleteResponseException,
+    LLMCallFailedException,
+    LLMProviderNotFoundException,
+    NoResponseException,
+    PromptTooLongException,
+    ServerBusyException,
+)
+from rate_limiter import ConcurrencyLimiter, ProviderRateLimiter
+from routing import ModelRouter, direct_response
+from schemas import get_settings
+from utils import (
+    count_tokens,
+    get_retry_after,
+    handle_azure_exception,
+    handle_gemini_exception,
+)
 
-from constants import GOOGLE_GENERATIVEAI_MODELS, LLM_PROVIDERS
-from exceptions import LLMProviderNotFoundException, NoResponseException
-from schemas import SecretVariables
-from utils import handle_azure_exception, handle_gemini_exception
 
-load_dotenv(override=True)  # Load the environment variables from a `.env` file.
+# Initialize variables required from environment variables.
+secret_variables = get_settings()
 
+# Only the first call configures the root logger; the ones on later reruns are no-ops.
+logging.basicConfig(level=secret_variables.log_level)
 logger = logging.getLogger()
 
-# Initialize variables required from environment variables.
-secret_variables = SecretVariables(
-    aether_api_key=os.getenv("AETHER_API_KEY"),  # type: ignore
-    aether_proxy_endpoint=os.getenv("AETHER_PROXY_ENDPOINT"),  # type: ignore
-    azure_api_key=os.getenv("AZURE_API_KEY"),  # type: ignore
-    azure_endpoint=os.getenv("AZURE_ENDPOINT"),  # type: ignore
-    azure_openai_api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-01"),
-    azure_provider_deployment=os.getenv("AZURE_PROVIDER_MODEL"),  # type: ignore
-    google_api_key=os.getenv("GOOGLE_API_KEY"),  # type: ignore
+# The time, in seconds, after which a request to the LLM is abandoned and retried.
+request_timeout = secret_variables.llm_request_timeout
+
+
+@st.cache_resource
+def get_llm_cache() -> LLMCache:
+    """Create the response cache once, shared across sessions and reruns.
+
+    The exact-match entries are kept in Redis if `REDIS_URL` is set, and in process
+    memory otherwise.
+    """
+
+    redis_url = secret_variables.redis_url
+
+    return LLMCache(backend=RedisCacheBackend(redis_url) if redis_url else None)
+
+
+llm_cache = get_llm_cache()
+
+
+@st.cache_resource
+def get_rate_limiter() -> ProviderRateLimiter:
+    """Create the rate limiter once, shared across sessions and reruns.
+
+    The default limits (see `constants.RATE_LIMITS`) can be extended or overridden
+    with a JSON object in `LLM_RATE_LIMITS`, e.g. `{"my-deployment": {"rpm": 500,
+    "tpm": 30000}}`.
+    """
+
+    limits = {**RATE_LIMITS, **secret_variables.llm_rate_limits}
+
+    return ProviderRateLimiter(limits=limits, respect_retry_after=True)
+
+
+rate_limiter = get_rate_limiter()
+
+
+@st.cache_resource
+def get_concurrency_limiter() -> ConcurrencyLimiter:
+    """Create the concurrency limiter once, shared across sessions and reruns.
+
+    The number of requests in flight is set with `MAX_INFLIGHT`.
+    """
+
+    return ConcurrencyLimiter(
+        max_inflight=secret_variables.max_inflight,
+        max_queued=MAX_QUEUED,
+        queue_deadline=QUEUE_DEADLINE,
+    )
+
+
+concurrency_limiter = get_concurrency_limiter()
+
+
+@st.cache_resource
+def get_model_router() -> ModelRouter:
+    """Create the model router once, shared across sessions and reruns."""
+
+    return ModelRouter()
+
+
+model_router = get_model_router()
+
+# The cheap model to try first for each provider, when routing is on.
+cheap_models = {**CHEAP_MODELS, "azure-openai": secret_variables.azure_router_model}
+
+# The system message that starts every conversation. It must stay identical across
+# requests (no timestamps, IDs, etc.) for the provider's prompt cache to hit.
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+# The Azure OpenAI clients for each mode. These are created once and reused, so that
+# calls go over already-open connections. Outside enterprise mode, identical
+# concurrent calls are coalesced; in enterprise mode, every prompt has to reach Aether,
+# for its policies to be enforced and the call to be logged.
+_AZURE_AETHER = get_azure_client(
+    api_key=secret_variables.aether_api_key,
+    azure_endpoint=secret_variables.aether_proxy_endpoint,
+    api_version=secret_variables.azure_openai_api_version,
+)
+_AZURE_DIRECT = get_coalescing_azure_client(
+    api_key=secret_variables.azure_api_key,
+    azure_endpoint=secret_variables.azure_endpoint,
+    api_version=secret_variables.azure_openai_api_version,
+)
+
+# Retry requests that time out, with exponential backoff. A request stuck in the tail
+# of the latency distribution is usually slower than a fresh one.
+_retry_on_timeout = retry(
+    stop=stop_after_attempt(REQUEST_MAX_ATTEMPTS),
+    wait=wait_exponential(multiplier=1, max=10),
+    retry=retry_if_exception_type(
+        (APITimeoutError, DeadlineExceeded, asyncio.TimeoutError)
+    ),
+    reraise=True,
 )
 
 
-def _google_generate(prompt: str, model_name: str, is_enterprise_mode: bool) -> str:
-    """Call the Gemini SDK's `.generate_content` method.
+async def _timed_chunks(
+    first: str, stream: AsyncIterator[str], timeout: float
+) -> AsyncIterator[str]:
+    try:
+        yield first
+        while True:
+            try:
+                chunk = await asyncio.wait_for(stream.__anext__(), timeout=timeout)
+            except StopAsyncIteration:
+                return
+            yield chunk
+    finally:
+        await stream.aclose()
+
+
+async def _within(stream: AsyncIterator[str], timeout: float) -> AsyncIterator[str]:
+    """Bound the time to the first chunk of a stream, and between its next chunks.
+
+    A deadline on the whole stream would cut off long answers; these only catch calls
+    that stall. The first chunk is awaited here, so that the time to it counts
+    towards the request, and is retried along with it.
+
+    Args
+    ----
+    stream: AsyncIterator[str]
+        The response from the LLM.
+    timeout: float
+        The time, in seconds, to wait for each chunk.
+
+    Returns
+    -------
+    chunks: AsyncIterator[str]
+        The chunks of `stream`, starting with the first one already received.
+    """
+
+    try:
+        first = await asyncio.wait_for(stream.__anext__(), timeout=timeout)
+    except StopAsyncIteration:
+        return _once("")
+    except BaseException:
+        await stream.aclose()
+        raise
+
+    return _timed_chunks(first, stream, timeout)
+
+
+@_retry_on_timeout
+async def _google_generate(
+    messages: list[dict[str, str]],
+    model_name: str,
+    is_enterprise_mode: bool,
+    request_timeout: float = DEFAULT_REQUEST_TIMEOUT,
+    logprobs: Optional[list[float]] = None,
+) -> AsyncIterator[str]:
+    """Call the Gemini SDK's `.generate_content_async` method, streaming the response.
 
     Use the Aether proxy if `is_enterprise_mode` is set; call the Gemini API directly if
     not.
 
     Args
     ----
-    prompt: str
-        The prompt to be given to the LLM.
+    messages: list of dict
+        The conversation to be given to the LLM, as `{"role", "content"}` dicts, ending
+        with the user's prompt. The system prompt is added here.
     model_name: str
         The name of the LLM to call using the Gemini SDK.
     is_enterprise_mode: bool
         If true, use the Aether proxy. Otherwise, call the Gemini API directly.
+    request_timeout: float
+        The time, in seconds, after which the request is abandoned if no more of the
+        response has arrived.
+    logprobs: list of float, optional
+        Ignored; the Gemini SDK doesn't return token log-probabilities.
 
     Returns
     -------
-    message: str
-        The text to be displayed on the Streamlit UI. The response from the LLM if the
-        call goes through; or the error message if it doesn't.
+    chunks: AsyncIterator[str]
+        The text of the response from the LLM, as it is generated. The request is
+        sent, and retried if needed, before this is returned.
     """
 
     if is_enterprise_mode:
-        # If enterprise mode is selected, pass the Aether API key and Aether proxy
-        # endpoint to the Gemini client.
-        genai.configure(
-            api_key=secret_variables.aether_api_key,
-            transport="rest",
-            client_options={"api_endpoint": secret_variables.aether_proxy_endpoint},
+        # If enterprise mode is selected, use the Aether API key and Aether proxy
+        # endpoint with the Gemini client.
+        model = get_gemini_model(
+            model_name,
+            secret_variables.aether_api_key,
+            secret_variables.aether_proxy_endpoint,
         )
     else:
-        # Otherwise, pass the Google API key and make a call directly to the Gemini API.
-        genai.configure(api_key=secret_variables.google_api_key)
+        # Otherwise, use the Google API key and make a call directly to the Gemini API.
+        model = get_gemini_model(model_name, secret_variables.google_api_key)
+
+    # The system prompt is set on the model; Gemini calls the assistant "model".
+    contents = [
+        {
+            "role": "model" if message["role"] == "assistant" else "user",
+            "parts": [message["content"]],
+        }
+        for message in messages
+    ]
+    # Retries are handled by `_retry_on_timeout`, so turn off the SDK's own. Over gRPC,
+    # a timeout would be a deadline for the whole stream, cutting off long answers, so
+    # the time between chunks is bounded by `_within` instead.
+    request_options = {"retry": None}
+    if is_enterprise_mode:
+        # The Aether proxy is reached over the REST transport, which the Gemini SDK's
+        # async client does not support; run the blocking calls in a worker thread
+        # instead so the event loop stays free. Over REST, the timeout applies to each
+        # read rather than the whole stream, and keeps the thread from hanging.
+        response = await asyncio.wait_for(
+            asyncio.to_thread(
+                model.generate_content,
+                contents,
+                stream=True,
+                request_options={**request_options, "timeout": request_timeout},
+            ),
+            timeout=request_timeout,
+        )
+        chunks = iter(response)
 
-    model = genai.GenerativeModel(model_name)
-    try:
-        response = model.generate_content(prompt)
-        logger.info("LLM response: %s", response.text)
-        return response.text
-    except GoogleAPIError as e:
-        logger.exception("Error: %s", repr(e))
-        return handle_gemini_exception(exc=e)
+        async def stream() -> AsyncIterator[str]:
+            while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+                yield chunk.text
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("LLM response: %s", response.text[:512])
 
+    else:
+        response = await asyncio.wait_for(
+            model.generate_content_async(
+                contents, stream=True, request_options=request_options
+            ),
+            timeout=request_timeout,
+        )
+
+        async def stream() -> AsyncIterator[str]:
+            async for chunk in response:
+                yield chunk.text
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("LLM response: %s", response.text[:512])
 
-def _azure_generate(
-    prompt: str, model_name: str, is_enterprise_mode: bool
-) -> Union[str, None]:
-    """Call the Azure OpenAI SDK's `.chat.completions.create` API.
+    return await _within(stream(), request_timeout)
+
+
+@_retry_on_timeout
+async def _azure_generate(
+    messages: list[dict[str, str]],
+    model_name: str,
+    is_enterprise_mode: bool,
+    request_timeout: float = DEFAULT_REQUEST_TIMEOUT,
+    logprobs: Optional[list[float]] = None,
+) -> AsyncIterator[str]:
+    """Call the Azure OpenAI SDK's `.chat.completions.create` API, streaming its output.
 
     Use the Aether proxy if `is_enterprise_mode` is set; call the Azure OpenAI API
     directly if not.
 
     Args
     ----
-    prompt: str
-        The prompt to be given to the LLM.
+    messages: list of dict
+        The conversation to be given to the LLM, as `{"role", "content"}` dicts, ending
+        with the user's prompt. The system prompt is added here.
     model_name: str
         The name of the LLM to call using the Azure OpenAI SDK.
     is_enterprise_mode: bool
         If true, use the Aether proxy. Otherwise, call the Azure OpenAI API directly.
+    request_timeout: float
+        The time, in seconds, after which the request is abandoned if no more of the
+        response has arrived.
+    logprobs: list of float, optional
+        If given, the log-probabilities of the response's tokens are requested, and
+        appended to this list as the response streams.
 
     Returns
     -------
-    message: str
-        The text to be displayed on the Streamlit UI. The response from the LLM if the
-        call goes through; or the error message if it doesn't.
+    chunks: AsyncIterator[str]
+        The text of the response from the LLM, as it is generated. The request is
+        sent, and retried if needed, before this is returned.
     """
 
+    # If enterprise mode is selected, use the client pointed at the Aether proxy;
+    # otherwise, use the one pointed at the Azure OpenAI endpoint, through which
+    # concurrent identical requests are coalesced into one.
     if is_enterprise_mode:
-        # If enterprise mode is selected, pass the Aether API key and Aether proxy
-        # endpoint to the Azure OpenAI client.
-        client = AzureOpenAI(
-            api_key=secret_variables.aether_api_key,
-            azure_endpoint=secret_variables.aether_proxy_endpoint,
-            api_version=secret_variables.azure_openai_api_version,
-        )
+        create = _AZURE_AETHER.chat.completions.create
     else:
-        # Otherwise, pass the Azure OpenAI API key and Azure OpenAI endpoint and make
-        # the call.
-        client = AzureOpenAI(
-            api_key=secret_variables.azure_api_key,
-            azure_endpoint=secret_variables.azure_endpoint,
-            api_version=secret_variables.azure_openai_api_version,
-        )
-
-    try:
-        response = client.chat.completions.create(
+        create = _AZURE_DIRECT.create
+    response = await asyncio.wait_for(
+        create(
             model=model_name,
-            messages=[{"role": "user", "content": prompt}],
-        )
-        return response.choices[0].message.content
-    except OpenAIAPIError as e:
-        logger.exception("Error: %s", repr(e))
-        return handle_azure_exception(e)
+            messages=[SYSTEM_MESSAGE, *messages],
+            stream=True,
+            timeout=request_timeout,
+            **({"logprobs": True} if logprobs is not None else {}),
+        ),
+        timeout=request_timeout,
+    )
+
+    async def stream() -> AsyncIterator[str]:
+        try:
+            async for chunk in response:
+                # Azure sends the content filter results in chunks without choices.
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                if logprobs is not None and choice.logprobs and choice.logprobs.content:
+                    logprobs.extend(token.logprob for token in choice.logprobs.content)
+                yield choice.delta.content or ""
+        except httpx.TimeoutException as e:
+            # The SDK only wraps timeouts before the response starts streaming.
+            raise asyncio.TimeoutError() from e
+
+    return await _within(stream(), request_timeout)
+
+
+# The function calling each LLM provider, by provider name.
+_HANDLERS: dict[str, Callable[..., Awaitable[AsyncIterator[str]]]] = {
+    "google-generativeai": _google_generate,
+    "azure-openai": _azure_generate,
+}
+
+
+async def _generate(
+    messages: list[dict[str, str]],
+    llm_provider: Literal["google-generativeai", "azure-openai"],
+    model_name: str,
+    is_enterprise_mode: bool,
+    logprobs: Optional[list[float]] = None,
+) -> AsyncIterator[str]:
+    """Call the LLM provider within its rate limits.
 
+    The request waits in process until the rate limiter admits it. If the provider
+    rate-limits it anyway, it is retried once the provider's `Retry-After` has passed.
 
-def invoke(
-    prompt: str,
+    Args
+    ----
+    messages: list of dict
+        The conversation to be given to the LLM, as `{"role", "content"}` dicts, ending
+        with the user's prompt.
+    llm_provider: "google-generativeai" or "azure-openai"
+        The provider of the LLM.
+    model_name: str
+        The name of the model to use.
+    is_enterprise_mode: bool
+        If true, use the Aether proxy. Otherwise, call the provider's API directly.
+    logprobs: list of float, optional
+        If given, collects the log-probabilities of the response's tokens, for the
+        providers that return them (Azure OpenAI).
+
+    Returns
+    -------
+    chunks: AsyncIterator[str]
+        The text of the response from the LLM, as it is generated.
+    """
+
+    handler = _HANDLERS.get(llm_provider)
+    if handler is None:
+        raise LLMProviderNotFoundException()
+
+    text = "\n".join(message["content"] for message in messages)
+    tokens = await asyncio.to_thread(count_tokens, llm_provider, model_name, text)
+    # Reject conversations that can't fit rather than paying for a round trip.
+    if tokens > CONTEXT_WINDOWS.get(model_name, DEFAULT_CONTEXT_WINDOW):
+        raise PromptTooLongException()
+
+    for attempt in range(1, RATE_LIMIT_MAX_ATTEMPTS + 1):
+        await rate_limiter.acquire(llm_provider, model_name, tokens)
+        try:
+            return await handler(
+                messages=messages,
+                model_name=model_name,
+                is_enterprise_mode=is_enterprise_mode,
+                request_timeout=request_timeout,
+                logprobs=logprobs,
+            )
+        except (OpenAIRateLimitError, ResourceExhausted) as e:
+            if attempt == RATE_LIMIT_MAX_ATTEMPTS:
+                raise
+            delay = rate_limiter.defer(llm_provider, model_name, get_retry_after(e))
+            logger.warning("Rate limited by %s; retrying in %.1fs", llm_provider, delay)
+
+
+async def _once(text: str) -> AsyncIterator[str]:
+    yield text
+
+
+async def _generate_routed(
+    messages: list[dict[str, str]],
     llm_provider: Literal["google-generativeai", "azure-openai"],
     model_name: str,
     is_enterprise_mode: bool,
-):
-    """Make the call to the LLM.
+    answered_by: Optional[list[str]] = None,
+) -> AsyncIterator[str]:
+    """Call the provider's cheap model first, escalating to `model_name` if needed.
+
+    Prompts that look complex go straight to `model_name`. For the others, the cheap
+    model's answer is used unless it is a refusal, fails, or (for Azure OpenAI) has a
+    low average token log-probability, in which case `model_name` is called instead.
 
     Args
     ----
-    prompt: str
-        The prompt to be given to the LLM.
+    messages: list of dict
+        The conversation to be given to the LLM, as `{"role", "content"}` dicts, ending
+        with the user's prompt.
     llm_provider: "google-generativeai" or "azure-openai"
         The provider of the LLM.
     model_name: str
-        The name of the model to use.
+        The name of the model the user asked for.
     is_enterprise_mode: bool
         If true, use the Aether proxy. Otherwise, call the provider's API directly.
+    answered_by: list of str, optional
+        If given, the name of the model that answers is appended to it.
 
     Returns
     -------
-    message: str
-        The text to be displayed on the Streamlit UI. The response from the LLM if the
-        call goes through; or the error message if it doesn't.
+    chunks: AsyncIterator[str]
+        The text of the response from the LLM.
     """
 
+    answered_by = [] if answered_by is None else answered_by
+    prompt = messages[-1]["content"]
+    cheap_model = cheap_models.get(llm_provider)
+    if cheap_model is None:
+        answered_by.append(model_name)
+        return await _generate(messages, llm_provider, model_name, is_enterprise_mode)
+
+    tokens = await asyncio.to_thread(count_tokens, llm_provider, model_name, prompt)
+    if model_router.route_model(prompt, tokens, model_name, cheap_model) == model_name:
+        answered_by.append(model_name)
+        return await _generate(messages, llm_provider, model_name, is_enterprise_mode)
+
+    # The cheap model's answer may have to be thrown away, so it is collected in full
+    # rather than streamed.
+    logprobs: list[float] = []
     try:
-        if prompt:
-            if llm_provider == "google-generativeai":
-                response = _google_generate(
-                    prompt=prompt,
-                    model_name=model_name,
-                    is_enterprise_mode=is_enterprise_mode,
-                )
-            elif llm_provider == "azure-openai":
-                response = _azure_generate(
-                    prompt=prompt,
-                    model_name=model_name,
-                    is_enterprise_mode=is_enterprise_mode,
-                )
+        stream = await _generate(
+            messages, llm_provider, cheap_model, is_enterprise_mode, logprobs=logprobs
+        )
+        response = "".join([chunk async for chunk in stream])
+    except (asyncio.TimeoutError, GoogleAPIError, OpenAIAPIError) as e:
+        logger.warning("The cheap model failed: %s", repr(e))
+        response = ""
+
+    if not model_router.should_escalate(response, logprobs):
+        answered_by.append(cheap_model)
+        return _once(response)
+
+    logger.info("Escalating from %s to %s", cheap_model, model_name)
+    model_router.record_escalation(prompt)
+
+    answered_by.append(model_name)
+    return await _generate(messages, llm_provider, model_name, is_enterprise_mode)
+
+
+async def _start(
+    messages: list[dict[str, str]],
+    llm_provider: Literal["google-generativeai", "azure-openai"],
+    model_name: str,
+    is_enterprise_mode: bool,
+) -> tuple[str, AsyncIterator[str], contextlib.AsyncExitStack]:
+    # Each leg of a hedged request holds its own concurrency slot, released when its
+    # stream is closed, so that `MAX_INFLIGHT` still bounds the calls in flight.
+    slot = contextlib.AsyncExitStack()
+    await slot.enter_async_context(concurrency_limiter.slot())
+    try:
+        stream = await _generate(messages, llm_provider, model_name, is_enterprise_mode)
+        try:
+            first = await stream.__anext__()
+        except StopAsyncIteration:
+            first = ""
+    except BaseException:
+        await slot.aclose()
+        raise
+
+    return first, stream, slot
+
+
+async def _resume(
+    first: str, stream: AsyncIterator[str], slot: contextlib.AsyncExitStack
+) -> AsyncIterator[str]:
+    try:
+        yield first
+        async for chunk in stream:
+            yield chunk
+    finally:
+        try:
+            if hasattr(stream, "aclose"):
+                await stream.aclose()
+        finally:
+            await slot.aclose()
+
+
+async def _generate_hedged(
+    messages: list[dict[str, str]],
+    model_map: dict[str, str],
+    is_enterprise_mode: bool,
+    answered_by: Optional[list[str]] = None,
+) -> AsyncIterator[str]:
+    """Send the request to several providers at once, and use the first to respond.
+
+    The providers race to their first chunk of the response; the others are then
+    cancelled. A provider that fails is dropped from the race, so the request only
+    fails if all of them do. Each provider's call holds a slot of the concurrency
+    limiter of its own.
+
+    Args
+    ----
+    messages: list of dict
+        The conversation to be given to the LLM, as `{"role", "content"}` dicts, ending
+        with the user's prompt.
+    model_map: dict
+        The name of the model to use for each provider, by provider name.
+    is_enterprise_mode: bool
+        If true, use the Aether proxy. Otherwise, call the providers' APIs directly.
+    answered_by: list of str, optional
+        If given, the name of the model that answers is appended to it.
+
+    Returns
+    -------
+    chunks: AsyncIterator[str]
+        The text of the response from the fastest provider, as it is generated.
+    """
+
+    models = {
+        asyncio.create_task(
+            _start(messages, llm_provider, model_name, is_enterprise_mode)
+        ): model_name
+        for llm_provider, model_name in model_map.items()
+    }
+    pending = set(models)
+    winner, error = None, None
+    try:
+        while pending and winner is None:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is not None:
+                    logger.warning("A hedged call failed: %s", repr(task.exception()))
+                    error = error or task.exception()
+                elif winner is None:
+                    winner = task.result()
+                    if answered_by is not None:
+                        answered_by.append(models[task])
+                else:  # Both responded at once; close the slower stream.
+                    _, stream, slot = task.result()
+                    await stream.aclose()
+                    await slot.aclose()
+    finally:
+        for task in pending:
+            task.cancel()
+
+    if winner is None:
+        raise error
+
+    return _resume(*winner)
+
+
+def _describe_error(exc: Exception) -> str:
+    """Turn an error from the LLM call into the message displayed on the UI."""
+
+    if isinstance(exc, PromptTooLongException):
+        return exc.message
+
+    logger.exception("Error: %s", repr(exc))
+    if isinstance(exc, asyncio.TimeoutError):
+        return "The LLM took too long to respond; please try again."
+    if isinstance(exc, GoogleAPIError):
+        return handle_gemini_exception(exc=exc)
+
+    return handle_azure_exception(exc)
 
-            if response is None:
-                raise NoResponseException()
 
-            return response
+async def invoke(
+    prompt: str,
+    llm_provider: Literal["google-generativeai", "azure-openai"],
+    model_name: str,
+    is_enterprise_mode: bool,
+    history: Sequence[dict[str, str]] = (),
+    use_routing: bool = False,
+    hedge_models: Optional[dict[str, str]] = None,
+    answered_by: Optional[list[str]] = None,
+) -> AsyncIterator[str]:
+    """Make the call to the LLM, streaming its response.
 
-        return "Your prompt is empty; please re-type your prompt and try again!"
+    Args
+    ----
+    prompt: str
+        The prompt to be given to the LLM.
+    llm_provider: "google-generativeai" or "azure-openai"
+        The provider of the LLM.
+    model_name: str
+        The name of the model to use.
+    is_enterprise_mode: bool
+        If true, use the Aether proxy. Otherwise, call the provider's API directly.
+    history: sequence of dict
+        The earlier turns of the conversation, as `{"role", "content"}` dicts.
+    use_routing: bool
+        If true, try a cheaper model of the same provider first.
+    hedge_models: dict, optional
+        If given, send the prompt to each of these providers, with the model given
+        for it, and use the first to respond; `llm_provider` and `model_name` are then
+        ignored.
+    answered_by: list of str, optional
+        If given, the name of the model that answers is appended to it. Nothing is
+        appended if the response comes from the cache, or not from an LLM at all.
+
+    Yields
+    ------
+    chunk: str
+        The text to be displayed on the Streamlit UI: the response from the LLM, as it
+        is generated.
+
+    Raises
+    ------
+    IncompleteResponseException
+        If the call fails after part of the response has been yielded; the error
+        message is not appended to it.
+    LLMCallFailedException
+        If the call fails before any of the response has been yielded. Its `message`
+        describes the error, for display.
+
+    Unexpected errors are raised to the caller, which runs on Streamlit's script thread
+    and can display them.
+    """
 
-    except Exception as e:
-        st.error(f"Error in invoke: {repr(e)}")
-        return "An error occurred while processing the request."
+    if prompt.strip():
+        # Answer trivial prompts (greetings, thanks) without calling the LLM. Not in
+        # enterprise mode: every enterprise-mode prompt has to reach Aether, for its
+        # policies to be enforced and the call to be logged.
+        response = None if is_enterprise_mode else direct_response(prompt)
+        if response is not None:
+            yield response
+            return
+
+        if hedge_models:
+            cache_model = "+".join(
+                f"{provider}/{model}"
+                for provider, model in sorted(hedge_models.items())
+            )
+        else:
+            cache_model = f"{llm_provider}/{model_name}"
+            if use_routing:
+                # The answer may come from the cheap model; don't serve it to requests
+                # for `model_name` alone.
+                cache_model = f"{cache_model}/routed"
+        # The conversation is sent in full on every turn. It is only ever appended
+        # to, so every request shares its prefix with the previous one, and the
+        # provider's prompt cache can skip re-processing it.
+        messages = [*history, {"role": "user", "content": prompt}]
+        # Serve repeated (or near-identical) requests from the cache. The cache is
+        # shared between sessions, so it is skipped in enterprise mode: every
+        # enterprise-mode prompt has to reach Aether, for its policies to be enforced
+        # and the call to be logged.
+        use_cache = not is_enterprise_mode
+        if use_cache:
+            response = await asyncio.to_thread(llm_cache.get, cache_model, messages)
+            if response is not None:
+                yield response
+                return
+
+        chunks = []
+        try:
+            # Hold a slot for as long as the response streams; if none frees up in
+            # time, the request fails fast with a `ServerBusyException`. Each leg of a
+            # hedged request holds its own slot instead.
+            async with contextlib.AsyncExitStack() as slot:
+                if not hedge_models:
+                    await slot.enter_async_context(concurrency_limiter.slot())
+                if hedge_models:
+                    stream = await _generate_hedged(
+                        messages, hedge_models, is_enterprise_mode, answered_by
+                    )
+                elif use_routing:
+                    stream = await _generate_routed(
+                        messages=messages,
+                        llm_provider=llm_provider,
+                        model_name=model_name,
+                        is_enterprise_mode=is_enterprise_mode,
+                        answered_by=answered_by,
+                    )
+                else:
+                    stream = await _generate(
+                        messages=messages,
+                        llm_provider=llm_provider,
+                        model_name=model_name,
+                        is_enterprise_mode=is_enterprise_mode,
+                    )
+                    if answered_by is not None:
+                        answered_by.append(model_name)
+                async for chunk in stream:
+                    chunks.append(chunk)
+                    yield chunk
+        except (
+            asyncio.TimeoutError,
+            GoogleAPIError,
+            OpenAIAPIError,
+            PromptTooLongException,
+        ) as e:
+            # Azure's first chunk is an empty, role-only delta; it displays nothing.
+            if any(chunks):
+                # Part of the response is already displayed; rather than appending
+                # the error message to it, let the caller flag it as failed.
+                logger.exception("Error: %s", repr(e))
+                raise IncompleteResponseException() from e
+            raise LLMCallFailedException(_describe_error(e)) from e
+
+        response = "".join(chunks)
+        if not response:
+            raise NoResponseException()
+
+        # Only complete, successful responses are cached; errors are retried next time.
+        if use_cache:
+            await asyncio.to_thread(llm_cache.set, cache_model, messages, response)
+
+        return
+
+    yield "Your prompt is empty; please re-type your prompt and try again!"
 
 
 # Initialize the session state. Future messages (prompts and LLM responses) will be
@@ -187,11 +793,26 @@ if "messages" not in st.session_state:
     ]
 
 # Set up the side-bar components:
-# - a checkbox for enterprise mode;
+# - checkboxes for enterprise mode, cost-aware routing and hedged mode;
 # - a select box for the LLM provider; and
 # - a select box for the model to use, depending on the provider selected.
 with st.sidebar:
     st.session_state.is_enterprise_mode = st.checkbox("Enterprise Mode")
+    st.session_state.use_routing = st.checkbox(
+        "Cost-aware routing",
+        help=(
+            "Try a cheaper model first, and only use the selected one if needed. The "
+            "cheaper model's answer is checked before it is shown, so it isn't "
+            "streamed."
+        ),
+    )
+    st.session_state.use_hedging = st.checkbox(
+        "Hedged mode",
+        help=(
+            "Send each prompt to both Azure OpenAI and Gemini, and use whichever "
+            "answers first."
+        ),
+    )
     col1, col2 = st.columns([0.5, 0.5], gap="medium")
     with col1:
         st.session_state.llm_provider = st.selectbox("LLM provider", LLM_PROVIDERS)
@@ -207,10 +828,33 @@ st.title("Aether Chatbot")
 st.subheader("Secured Chat Assistant")
 st.divider()
 
+
+@st.cache_data(show_spinner=False, max_entries=HISTORY_CACHE_ENTRIES)
+def render_message(role: str, response: str, model: Optional[str] = None) -> None:
+    """Display a message of the chat history.
+
+    Streamlit replays the elements of a cached call instead of building them again,
+    so only the messages added since the last rerun are rendered from scratch.
+
+    Args
+    ----
+    role: str
+        The role of the message's author, "user" or "assistant".
+    response: str
+        The text of the message.
+    model: str, optional
+        The model that wrote the response, if it came from an LLM.
+    """
+
+    with st.chat_message(role):
+        st.markdown(response)
+        if model is not None:
+            st.caption(f"Answered by {model}")
+
+
 # Display the chat history.
 for message in st.session_state.messages:
-    with st.chat_message(message["role"]):
-        st.markdown(message["response"])
+    render_message(message["role"], message["response"], message.get("model"))
 
 # Process the prompt from the user.
 if prompt := st.chat_input("Ask anything..."):
@@ -220,30 +864,71 @@ if prompt := st.chat_input("Ask anything..."):
     with st.chat_message("user"):
         st.markdown(prompt)
 
-    response = {}
+    response = ""
     response_instance = st.chat_message("assistant")
-    model_name = ""
 
+    # Unknown providers are rejected by `invoke`.
+    llm_provider = st.session_state.llm_provider
+    if llm_provider == "azure-openai":
+        model_name = secret_variables.azure_provider_deployment
+    else:
+        model_name = st.session_state.model_selected
+    hedge_models = None
+    if st.session_state.use_hedging:
+        hedge_models = {
+            "azure-openai": secret_variables.azure_provider_deployment,
+            "google-generativeai": st.session_state.get(
+                "model_selected", GOOGLE_GENERATIVEAI_MODELS[0]
+            ),
+        }
+
+    answered_by: list[str] = []
     with response_instance:
-        # The loading state.
-        with st.spinner("Analyzing..."):
-            llm_provider = st.session_state.llm_provider
-            if llm_provider not in ("google-generativeai", "azure-openai"):
-                raise LLMProviderNotFoundException()
-            elif llm_provider == "google-generativeai":
-                model_name = st.session_state.model_selected
-            elif llm_provider == "azure-openai":
-                model_name = secret_variables.azure_provider_deployment
-
-            # Make the LLM call.
-            response = invoke(
-                prompt=prompt,
-                llm_provider=llm_provider,
-                model_name=model_name,
-                is_enterprise_mode=st.session_state.is_enterprise_mode,
+        # Make the LLM call, writing out the response as it is generated. `invoke` runs
+        # on the shared event loop.
+        try:
+            response = response_instance.write_stream(
+                iterate_async(
+                    invoke(
+                        prompt=prompt,
+                        llm_provider=llm_provider,
+                        model_name=model_name,
+                        is_enterprise_mode=st.session_state.is_enterprise_mode,
+                        use_routing=st.session_state.use_routing,
+                        hedge_models=hedge_models,
+                        answered_by=answered_by,
+                        # Leave out the greeting, the prompt just added, and the
+                        # exchanges that failed.
+                        history=[
+                            {"role": message["role"], "content": message["response"]}
+                            for message in st.session_state.messages[1:-1]
+                            if not message.get("failed")
+                        ],
+                    )
+                )
             )
-
-    # Update the session state with the new response.
-    with response_instance:
-        st.markdown(response)
-        st.session_state.messages.append({"role": "assistant", "response": response})
+            failed = False
+            if answered_by:
+                st.caption(f"Answered by {answered_by[-1]}")
+        except (
+            IncompleteResponseException,
+            LLMCallFailedException,
+            ServerBusyException,
+        ) as e:
+            st.error(e.message)
+            response, failed = e.message, True
+        except Exception as e:
+            st.error(f"Error in invoke: {repr(e)}")
+            response, failed = "An error occurred while processing the request.", True
+
+        # Update the session state with the new response. Failed exchanges are still
+        # displayed, but not sent back to the LLM as part of the conversation.
+        st.session_state.messages[-1]["failed"] = failed
+        st.session_state.messages.append(
+            {
+                "role": "assistant",
+                "response": response,
+                "failed": failed,
+                "model": answered_by[-1] if answered_by and not failed else None,
+            }
+        )
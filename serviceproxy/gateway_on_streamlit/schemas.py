@@ -1,7 +1,24 @@
-from pydantic import BaseModel
+import functools
+import json
+import logging
+import math
+import os
+from pathlib import Path
+from types import MappingProxyType
+from typing import Any, Callable, Mapping, NamedTuple, Optional, TypeVar
 
+from dotenv import dotenv_values
 
-class SecretVariables(BaseModel):
+from constants import DEFAULT_MAX_INFLIGHT, DEFAULT_REQUEST_TIMEOUT
+from exceptions import (
+    InvalidEnvironmentVariableException,
+    MissingEnvironmentVariableException,
+)
+
+T = TypeVar("T")
+
+
+class SecretVariables(NamedTuple):
     """Variables required from the ENV to run this example."""
 
     aether_api_key: str
@@ -11,3 +28,118 @@ class SecretVariables(BaseModel):
     azure_openai_api_version: str
     azure_provider_deployment: str
     google_api_key: str
+
+    # Optional settings.
+    azure_router_model: Optional[str] = None
+    llm_rate_limits: Mapping[str, Mapping[str, int]] = MappingProxyType({})
+    llm_request_timeout: float = DEFAULT_REQUEST_TIMEOUT
+    log_level: str = "WARNING"
+    max_inflight: int = DEFAULT_MAX_INFLIGHT
+    redis_url: Optional[str] = None
+
+
+def _is_positive_int(value: Any) -> bool:
+    # `bool` is a subclass of `int`, but JSON's `true` is not a limit.
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+
+def _parse_positive_int(value: str) -> int:
+    number = int(value)
+    if number <= 0:
+        raise ValueError(f"expected a positive integer, got {number}")
+
+    return number
+
+
+def _parse_positive_float(value: str) -> float:
+    number = float(value)
+    if not (math.isfinite(number) and number > 0):
+        raise ValueError(f"expected a positive number, got {number}")
+
+    return number
+
+
+def _parse_rate_limits(value: str) -> Mapping[str, Mapping[str, int]]:
+    limits: Any = json.loads(value)
+    if not isinstance(limits, dict) or not all(
+        isinstance(limit, dict)
+        and {"rpm", "tpm"} <= limit.keys()
+        and _is_positive_int(limit["rpm"])
+        and _is_positive_int(limit["tpm"])
+        for limit in limits.values()
+    ):
+        raise ValueError(
+            'expected {"<model>": {"rpm": ..., "tpm": ...}, ...}, with positive '
+            "integer limits"
+        )
+
+    return MappingProxyType(limits)
+
+
+def _parse_log_level(value: str) -> str:
+    level = value.strip().upper()
+    if not isinstance(logging.getLevelName(level), int):
+        raise ValueError("expected one of DEBUG, INFO, WARNING, ERROR or CRITICAL")
+
+    return level
+
+
+@functools.lru_cache(maxsize=1)
+def get_settings() -> SecretVariables:
+    """Read the variables from the ENV once; Streamlit reruns reuse the instance.
+
+    The variables are read from the environment, and from the `.env` file in this
+    folder for those that are not set there.
+
+    Returns
+    -------
+    secret_variables: SecretVariables
+        The variables, converted to their types.
+
+    Raises
+    ------
+    MissingEnvironmentVariableException
+        If a required variable is set neither in the environment nor in `.env`.
+    InvalidEnvironmentVariableException
+        If a variable can't be converted to its type, or is out of range.
+    """
+
+    env = {**dotenv_values(Path(__file__).with_name(".env")), **os.environ}
+
+    def required(name: str) -> str:
+        value = env.get(name)
+        if value is None:
+            raise MissingEnvironmentVariableException(name)
+
+        return value
+
+    def optional(name: str, parse: Callable[[str], T], default: T) -> T:
+        value = env.get(name)
+        if value is None:
+            return default
+        try:
+            return parse(value)
+        except ValueError as e:  # Including `json.JSONDecodeError`.
+            raise InvalidEnvironmentVariableException(f"{name}: {e}") from None
+
+    return SecretVariables(
+        aether_api_key=required("AETHER_API_KEY"),
+        aether_proxy_endpoint=required("AETHER_PROXY_ENDPOINT"),
+        azure_api_key=required("AZURE_API_KEY"),
+        azure_endpoint=required("AZURE_ENDPOINT"),
+        azure_openai_api_version=env.get("AZURE_OPENAI_API_VERSION", "2024-02-01"),
+        azure_provider_deployment=required("AZURE_PROVIDER_MODEL"),
+        google_api_key=required("GOOGLE_API_KEY"),
+        azure_router_model=env.get("AZURE_ROUTER_MODEL"),
+        llm_rate_limits=optional(
+            "LLM_RATE_LIMITS", _parse_rate_limits, MappingProxyType({})
+        ),
+        llm_request_timeout=optional(
+            "LLM_REQUEST_TIMEOUT", _parse_positive_float, DEFAULT_REQUEST_TIMEOUT
+        ),
+        log_level=optional("LOG_LEVEL", _parse_log_level, "WARNING"),
+        max_inflight=optional(
+            "MAX_INFLIGHT", _parse_positive_int, DEFAULT_MAX_INFLIGHT
+        ),
+        redis_url=env.get("REDIS_URL"),
+    )
@@ -1,6 +1,65 @@
+import functools
+import logging
+import time
+from typing import Any, Callable, Optional
+
+import tiktoken
 from google.api_core.exceptions import GoogleAPIError
 from openai import APIError
 
+from cache import InMemoryCacheBackend
+from constants import (
+    DEFAULT_TIKTOKEN_ENCODING,
+    ERROR_MESSAGE_CACHE_ENTRIES,
+    TOKEN_COUNT_CACHE_ENTRIES,
+    TOKENIZER_RETRY_SECONDS,
+)
+
+logger = logging.getLogger()
+
+# Rate-limit storms raise the same error over and over; remember the message for each
+# distinct error rather than parsing its body again every time.
+_error_messages = InMemoryCacheBackend(max_entries=ERROR_MESSAGE_CACHE_ENTRIES)
+
+
+def _error_message(exc: Exception, parse: Callable[[Exception], str]) -> str:
+    key = f"{type(exc).__name__}:{exc}"
+    message = _error_messages.get(key)
+    if message is None:
+        message = parse(exc)
+        _error_messages.set(key, message)
+
+    return message
+
+
+def _response_json(response: Any) -> dict[str, Any]:
+    # Not every response has a JSON body (gRPC errors don't have a body at all), and
+    # reading it may hit the network again, so the parsed body is kept on the response.
+    body = getattr(response, "_cached_json", None)
+    if body is None:
+        try:
+            body = response.json()
+        except Exception:
+            body = {}
+        try:
+            response._cached_json = body
+        except AttributeError:  # E.g. the response uses `__slots__`.
+            pass
+
+    return body if isinstance(body, dict) else {}
+
+
+def _parse_gemini_exception(exc: GoogleAPIError) -> str:
+    error = _response_json(getattr(exc, "response", None)).get("error")
+
+    return error.get("message", repr(exc)) if isinstance(error, dict) else repr(exc)
+
+
+def _parse_azure_exception(exc: APIError) -> str:
+    body = getattr(exc, "body", None)
+
+    return body.get("message", repr(exc)) if isinstance(body, dict) else repr(exc)
+
 
 def handle_gemini_exception(exc: GoogleAPIError) -> str:
     """Handle exceptions from the Gemini client.
@@ -16,9 +75,7 @@ def handle_gemini_exception(exc: GoogleAPIError) -> str:
         The string to be displayed on the Streamlit UI.
     """
 
-    message = exc.response.json().get("error", {}).get("message", repr(exc))
-
-    return message
+    return _error_message(exc, _parse_gemini_exception)
 
 
 def handle_azure_exception(exc: APIError) -> str:
@@ -35,4 +92,95 @@ def handle_azure_exception(exc: APIError) -> str:
         The string to be displayed on the Streamlit UI.
     """
 
-    return exc.body.get("message", repr(exc))
+    return _error_message(exc, _parse_azure_exception)
+
+
+def get_retry_after(exc: Exception) -> Optional[float]:
+    """Read the time to wait before retrying from a rate-limited response.
+
+    Args
+    ----
+    exc: Exception
+        The exception from the rate-limited API call.
+
+    Returns
+    -------
+    retry_after: float, optional
+        The time, in seconds, given by the `Retry-After` (or Azure's `Retry-After-Ms`)
+        header; `None` if the response has no such header.
+    """
+
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:  # E.g. an HTTP date rather than a number of seconds.
+        pass
+
+    return None
+
+
+# The `tiktoken` encodings loaded so far, and when to try again to load those that
+# couldn't be (e.g. because they couldn't be downloaded), by model name.
+_encodings: dict[str, tiktoken.Encoding] = {}
+_encoding_retry_at: dict[str, float] = {}
+
+
+def _get_encoding(model_name: str) -> Optional[tiktoken.Encoding]:
+    encoding = _encodings.get(model_name)
+    if encoding is not None or time.monotonic() < _encoding_retry_at.get(model_name, 0):
+        return encoding
+
+    try:
+        try:
+            encoding = tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            # Deployment names don't have to match a model name.
+            encoding = tiktoken.get_encoding(DEFAULT_TIKTOKEN_ENCODING)
+    except Exception as e:  # E.g. the encoding could not be downloaded.
+        logger.warning("Could not load the tiktoken encoding: %s", repr(e))
+        _encoding_retry_at[model_name] = time.monotonic() + TOKENIZER_RETRY_SECONDS
+
+        return None
+
+    _encodings[model_name] = encoding
+
+    return encoding
+
+
+@functools.lru_cache(maxsize=TOKEN_COUNT_CACHE_ENTRIES)
+def _count_tokens(encoding: tiktoken.Encoding, text: str) -> int:
+    return len(encoding.encode(text))
+
+
+def count_tokens(llm_provider: str, model_name: str, text: str) -> int:
+    """Count the tokens in a prompt.
+
+    The counts are cached, as the same conversation is counted again on every attempt
+    and by the router. Estimates are not, so that the exact count is used once the
+    encoding can be loaded.
+
+    Args
+    ----
+    llm_provider: str
+        The provider of the LLM.
+    model_name: str
+        The name of the model (or, for Azure OpenAI, of the deployment).
+    text: str
+        The prompt.
+
+    Returns
+    -------
+    tokens: int
+        The number of tokens in the prompt with the model's `tiktoken` encoding for
+        Azure OpenAI; roughly one per four characters for Gemini, whose tokenizer is
+        only available through an API call, or if the encoding can't be loaded.
+    """
+
+    encoding = _get_encoding(model_name) if llm_provider == "azure-openai" else None
+    if encoding is None:
+        return len(text) // 4 + 1
+
+    return _count_tokens(encoding, text)